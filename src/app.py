@@ -1,42 +1,71 @@
 """Main application - polls DB for pending attachments and downloads them."""
 import signal
 import sys
+import threading
 import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, CancelledError, Future, ThreadPoolExecutor, wait
+from urllib.parse import urlparse
 
 from src.logging_conf import logger
 from src import settings
 from src.db import Database
-from src.attachment_processor import AttachmentProcessor
+from src.attachment_processor import AttachmentProcessor, DownloadCancelled
 
 
 class Application:
     """Main application that polls DB and processes attachments."""
     
     def __init__(self):
+        # Before anything is built from the settings (the pools below reject bad sizes less clearly)
+        settings.validate_config()
+        
         self.db = Database()
         self.processor = AttachmentProcessor()
         self.running = False
+        
+        # Set by stop(); idle waits block on it, so shutdown doesn't sit out a poll interval
+        self._stop_event = threading.Event()
+        
+        # Current idle wait: doubles while there is no work, resets when a batch has some
+        self._poll_interval = settings.POLL_INTERVAL
+        self._max_poll_interval = max(settings.MAX_POLL_INTERVAL, settings.POLL_INTERVAL)
+        
+        # Download workers live for the whole run (no thread startup per batch)
+        self._downloader = ThreadPoolExecutor(max_workers=settings.DOWNLOAD_CONCURRENCY, thread_name_prefix="download")
+        
+        # Single background slot that fetches the next batch during downloads
+        self._prefetcher = ThreadPoolExecutor(max_workers=1, thread_name_prefix="prefetch")
+        self._next_batch: Future | None = None
     
     def start(self):
         """Start the application."""
         logger.info("=" * 50)
         logger.info("Missive Attachment Downloader")
         logger.info("=" * 50)
-        logger.info(f"Storage: {settings.ATTACHMENT_STORAGE_PATH}")
-        logger.info(f"Poll interval: {settings.POLL_INTERVAL}s")
+        logger.info("Storage: %s", settings.ATTACHMENT_STORAGE_PATH)
+        logger.info("Poll interval: %ss (up to %ss when idle)", settings.POLL_INTERVAL, self._max_poll_interval)
+        logger.info("Download concurrency: %s", settings.DOWNLOAD_CONCURRENCY)
         if settings.SKIP_SENDER_DOMAINS:
-            logger.info(f"Skip outgoing from: {', '.join(settings.SKIP_SENDER_DOMAINS)}")
+            logger.info("Skip outgoing from: %s", ', '.join(settings.SKIP_SENDER_DOMAINS))
         logger.info("=" * 50)
         
-        settings.validate_config()
         self.running = True
         logger.info("Started - watching for pending attachments")
     
     def stop(self):
-        """Stop the application."""
+        """Ask the main loop to stop. run() shuts down once the current batch's claims are settled."""
         if not self.running:
             return
         self.running = False
+        self._stop_event.set()
+        self.processor.cancel()  # Running downloads stop at their next chunk instead of finishing
+    
+    def _shutdown(self):
+        """Release worker threads and connections."""
+        self._prefetcher.shutdown(wait=True, cancel_futures=True)
+        self._downloader.shutdown(wait=True, cancel_futures=True)
+        self.processor.close()
         self.db.close()
         logger.info("Stopped")
     
@@ -51,17 +80,21 @@ class Application:
             try:
                 processed = self._process_batch()
                 
-                # If no work, sleep before next poll
-                if not processed:
-                    time.sleep(settings.POLL_INTERVAL)
+                # If no work, sleep before next poll, backing off while the queue stays empty
+                if processed:
+                    self._poll_interval = settings.POLL_INTERVAL
+                else:
+                    self._stop_event.wait(self._poll_interval)
+                    self._poll_interval = min(self._poll_interval * 2, self._max_poll_interval)
                     
             except KeyboardInterrupt:
                 break
             except Exception as e:
-                logger.error(f"Error in main loop: {e}", exc_info=True)
-                time.sleep(5)
+                logger.error("Error in main loop: %s", e, exc_info=True)
+                self._stop_event.wait(5)
         
         self.stop()
+        self._shutdown()
     
     # Always skip these (media_type, sub_type) combinations
     SKIP_TYPES = {
@@ -77,23 +110,26 @@ class Application:
     # Skip files with these extensions (case-insensitive)
     SKIP_EXTENSIONS = {'.p7s', '.p7m', '.ics', '.vcf'}
     
+    # Outgoing-mail domains as one tuple, so a single endswith() call checks them all
+    SKIP_SENDER_SUFFIXES = tuple(settings.SKIP_SENDER_DOMAINS)
+    
     def _should_skip(self, attachment: dict) -> str | None:
         """Check if attachment should be skipped. Returns skip reason or None."""
         # Skip outgoing emails (sender matches configured domains)
-        sender_email = (attachment.get('sender_email') or '').lower()
-        if sender_email and settings.SKIP_SENDER_DOMAINS:
-            for domain in settings.SKIP_SENDER_DOMAINS:
-                if sender_email.endswith(domain):
-                    return "outgoing email: attachments are only downloaded for incoming emails"
+        if self.SKIP_SENDER_SUFFIXES:
+            sender_email = (attachment.get('sender_email') or '').lower()
+            if sender_email.endswith(self.SKIP_SENDER_SUFFIXES):
+                return "outgoing email: attachments are only downloaded for incoming emails"
         
         filename = (attachment.get('original_filename') or '').lower()
         media_type = attachment.get('media_type')
         sub_type = attachment.get('sub_type')
         
-        # Skip by extension (catches mistyped MIME types like smime.p7s as octet-stream)
-        for ext in self.SKIP_EXTENSIONS:
-            if filename.endswith(ext):
-                return f"skip extension: {ext}"
+        # Skip by extension (catches mistyped MIME types like smime.p7s as octet-stream);
+        # one set lookup on the last suffix instead of an endswith() per extension
+        ext = filename[filename.rfind('.'):] if '.' in filename else ''
+        if ext in self.SKIP_EXTENSIONS:
+            return f"skip extension: {ext}"
         
         # Skip signatures, calendar invites, contact cards
         if (media_type, sub_type) in self.SKIP_TYPES:
@@ -122,59 +158,139 @@ class Application:
         
         return None
     
+    def _fetch_batch(self) -> list[dict]:
+        """Fetch pending attachments and refresh soon-to-expire URLs before they are downloaded."""
+        attachments = self.db.get_pending_attachments(settings.BATCH_SIZE)
+        if attachments:
+            self.processor.refresh_expiring_urls(attachments, db=self.db)
+        return attachments
+    
     def _process_batch(self) -> int:
         """Process a batch of pending attachments. Returns count processed."""
-        attachments = self.db.get_pending_attachments(settings.BATCH_SIZE)
+        # Use the batch prefetched while the previous one was downloading
+        if self._next_batch is not None:
+            # Clear the slot first: a failed prefetch raises once, not on every later loop
+            prefetched, self._next_batch = self._next_batch, None
+            attachments = prefetched.result()
+        else:
+            attachments = self._fetch_batch()
         
-        if not attachments:
+        if not attachments or self._stop_event.is_set():
             return 0
         
-        processed = 0
+        # Claim the whole batch at once (atomic, safe with multiple workers)
+        claimed = self.db.claim_batch([a['missive_attachment_id'] for a in attachments])
+        
+        skipped = 0
+        to_download = []
         for attachment in attachments:
-            if not self.running:
-                break
-            
             attachment_id = attachment['missive_attachment_id']
-            
-            # Try to claim this attachment
-            if not self.db.mark_downloading(attachment_id):
+            if attachment_id not in claimed:
                 continue  # Already claimed by another worker
             
             # Check if should be skipped
             skip_reason = self._should_skip(attachment)
             if skip_reason:
                 self.db.mark_skipped(attachment_id, skip_reason)
-                processed += 1
+                skipped += 1
                 continue
             
-            try:
-                local_filename = self.processor.process(attachment, db=self.db)
-                self.db.mark_completed(attachment_id, local_filename)
-                processed += 1
-                
-            except Exception as e:
-                self.db.mark_failed(attachment_id, str(e)[:500])
+            to_download.append(attachment)
+        
+        downloaded, failed, total_bytes = self._download_all(to_download) if to_download else (0, 0, 0)
+        
+        # One summary line per batch instead of per-file INFO logs
+        if claimed:
+            logger.info("Batch: %s downloaded (%s bytes), %s skipped, %s failed", downloaded, total_bytes, skipped, failed)
+        return downloaded + skipped
+    
+    def _download_all(self, to_download: list[dict]) -> tuple[int, int, int]:
+        """Download claimed attachments in parallel. Returns (downloaded, failed, total_bytes)."""
+        # Fetch the next batch (and pre-refresh its URLs) in the background; claimed rows are no longer pending
+        self._next_batch = self._prefetcher.submit(self._fetch_batch)
+        
+        # Queue per host (each host's downloads run back-to-back on its keep-alive connections);
+        # at most MAX_PER_HOST_CONCURRENCY per host are submitted at a time, so pool workers
+        # never sit blocked on a busy host while other hosts' downloads wait behind them
+        by_host: dict[str, deque] = {}
+        for attachment in to_download:
+            host = urlparse(attachment.get('original_url') or '').netloc
+            by_host.setdefault(host, deque()).append(attachment)
+        in_flight = dict.fromkeys(by_host, 0)
         
-        return processed
+        now_ts = int(time.time())
+        futures: dict[Future, tuple[str, dict]] = {}
+        
+        # Claimed rows this worker won't finish; handed back to 'pending' at the end, so a
+        # restart picks them up instead of waiting out reset_stuck_downloads' cutoff
+        unfinished: list[str] = []
+        
+        def submit_ready():
+            for host, queue in by_host.items():
+                while queue and in_flight[host] < settings.MAX_PER_HOST_CONCURRENCY and not self._stop_event.is_set():
+                    attachment = queue.popleft()
+                    future = self._downloader.submit(self.processor.process, attachment, db=self.db, now_ts=now_ts)
+                    futures[future] = (host, attachment)
+                    in_flight[host] += 1
+        
+        # Status updates stay on this thread
+        downloaded = failed = total_bytes = 0
+        submit_ready()
+        while futures:
+            if self._stop_event.is_set():
+                # Not-yet-started downloads come back as CancelledError below
+                for future in futures:
+                    future.cancel()
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                host, attachment = futures.pop(future)
+                in_flight[host] -= 1
+                attachment_id = attachment['missive_attachment_id']
+                try:
+                    local_filename, size = future.result()
+                    self.db.mark_completed(attachment_id, local_filename)
+                    downloaded += 1
+                    total_bytes += size
+                    
+                except (CancelledError, DownloadCancelled):
+                    # Shutting down: not a failure
+                    unfinished.append(attachment_id)
+                except Exception as e:
+                    if self.db.mark_failed(attachment_id, str(e)[:500], attachment.get('retry_count')):
+                        failed += 1
+                    else:
+                        logger.warning("Download of %s failed but could not be recorded", attachment_id)
+                        unfinished.append(attachment_id)
+            submit_ready()
+        
+        # Rows never submitted because of a stop
+        for queue in by_host.values():
+            unfinished.extend(a['missive_attachment_id'] for a in queue)
+        if unfinished:
+            released = self.db.release_claims(unfinished)
+            logger.info("Released %s of %s unfinished claims", released, len(unfinished))
+        
+        return downloaded, failed, total_bytes
 
 
 def main():
     """Entry point."""
-    app = Application()
+    try:
+        app = Application()
+    except ValueError as e:
+        logger.error("Configuration error: %s", e)
+        sys.exit(1)
     
     def signal_handler(sig, frame):
-        logger.info(f"Received signal {sig}")
-        app.stop()
-        sys.exit(0)
+        logger.info("Received signal %s", sig)
+        if not app.running:
+            sys.exit(0)  # Not started yet, or a second signal while shutting down
+        app.stop()  # run() returns once the current batch is settled
     
     signal.signal(signal.SIGINT, signal_handler)
     signal.signal(signal.SIGTERM, signal_handler)
     
-    try:
-        app.run()
-    except ValueError as e:
-        logger.error(f"Configuration error: {e}")
-        sys.exit(1)
+    app.run()
 
 
 if __name__ == "__main__":
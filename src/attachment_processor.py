@@ -1,14 +1,123 @@
 """Download and save email attachments."""
+import errno
+import os
 import re
-import requests
+import string
+import threading
+import time
+from functools import lru_cache
+import urllib3
+from urllib3.util.retry import Retry
 from pathlib import Path
-from datetime import datetime, timezone
-from urllib.parse import urlparse, parse_qs
-from typing import Dict, Any, Tuple
+from datetime import datetime
+from typing import Dict, Any, List, Optional, Set, Tuple
 
 from src import settings
 from src.logging_conf import logger
-from src.missive_client import MissiveClient
+from src.missive_client import URL_REFRESH_LEAD_SECONDS, MissiveClient, url_expires_at
+
+# Read size when streaming a download to disk
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+# Bodies above this size are preallocated and streamed in LARGE_DOWNLOAD_CHUNK_SIZE writes
+LARGE_DOWNLOAD_BYTES = 1024 * 1024
+LARGE_DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+# Timeouts in seconds: fail fast on dead hosts, stay patient on slow bodies
+DOWNLOAD_TIMEOUT = urllib3.Timeout(connect=5, read=60)
+
+# Forget cached folders past this many (bounds memory in a long-running worker)
+MAX_KNOWN_FOLDERS = 10000
+
+
+def _byte_table(is_unsafe, overrides: Dict[str, str] = None) -> bytes:
+    """Build a 256-byte bytes.translate table mapping unsafe ASCII chars to '_'."""
+    table = bytearray(range(256))
+    for b in range(128):
+        if is_unsafe(chr(b)):
+            table[b] = ord('_')
+    for char, repl in (overrides or {}).items():
+        table[ord(char)] = ord(repl)
+    return bytes(table)
+
+
+# Per-byte lookup tables: one C-level pass instead of the regex engine
+_SAFE_CHARS = frozenset(string.ascii_letters + string.digits + '._-')
+_FILENAME_TABLE = _byte_table(lambda c: c not in _SAFE_CHARS, {' ': '-'})
+_SENDER_TABLE = _byte_table(lambda c: c not in _SAFE_CHARS and c != '@')
+_FS_UNSAFE_TABLE = _byte_table(lambda c: c in '<>:"/\\|?*' or c < ' ')
+_FS_UNSAFE_RE = re.compile(r'[<>:"/\\|?*\x00-\x1f]')  # Non-ASCII fallback
+
+# Run-collapsing patterns (translate can't merge runs)
+_SUBJECT_RUNS_RE = re.compile(r'[\s_]+')
+_FILENAME_RUNS_RE = re.compile(r'[-_]+')
+
+
+def _translate_allowed(text: str, table: bytes) -> str:
+    """Apply an allow-list table. Non-ASCII chars encode to '?', which the table maps to '_'."""
+    return text.encode('ascii', 'replace').translate(table).decode('ascii')
+
+
+@lru_cache(maxsize=4096)
+def _format_delivered_date(delivered_at) -> str:
+    """Format delivered_at as yyyymmdd ('00000000' if missing or unparseable).
+    
+    Cached on the raw value: every attachment of a message shares its timestamp.
+    """
+    if not delivered_at:
+        return "00000000"
+    if isinstance(delivered_at, datetime):
+        return delivered_at.strftime("%Y%m%d")
+    raw = str(delivered_at).replace('Z', '+00:00')
+    # Always parse, so impossible dates/times map to '00000000' as before; the parse is cheap
+    try:
+        dt = datetime.fromisoformat(raw)
+    except (ValueError, TypeError):
+        return "00000000"
+    # Fast path: for the YYYY-MM-DD[T ]... strings PostgREST returns, the validated date is a
+    # slice of the input, which skips strftime (most of the cost). Years below 1000 keep
+    # strftime's unpadded %Y
+    if raw[4:5] == '-' and raw[7:8] == '-' and raw[10:11] in ('', 'T', ' ') and raw[0] != '0':
+        return raw[0:4] + raw[5:7] + raw[8:10]
+    return dt.strftime("%Y%m%d")
+
+
+def _content_length(response) -> int:
+    """Declared body size on disk, or 0 if unknown (missing, invalid, or compressed in transit)."""
+    if 'Content-Encoding' in response.headers:
+        return 0
+    try:
+        return int(response.headers.get('Content-Length') or 0)
+    except ValueError:
+        return 0
+
+
+def _preallocate(fd: int, length: int) -> None:
+    """Reserve disk space up front so a large file is laid out in few extents. Best effort."""
+    if hasattr(os, 'posix_fallocate'):
+        try:
+            os.posix_fallocate(fd, 0, length)
+        except OSError:
+            pass
+
+
+class DownloadCancelled(Exception):
+    """Download aborted because the worker is shutting down."""
+
+
+class DownloadHTTPError(Exception):
+    """Download answered with an HTTP error status (after pool retries)."""
+    
+    def __init__(self, status: int, url: str):
+        super().__init__(f"HTTP {status} downloading {url}")
+        self.status = status
+
+
+def _replace_fs_unsafe(text: str) -> str:
+    """Replace filesystem-unsafe chars with '_', keeping non-ASCII text intact."""
+    if text.isascii():
+        return text.encode('ascii').translate(_FS_UNSAFE_TABLE).decode('ascii')
+    return _FS_UNSAFE_RE.sub('_', text)
 
 
 class AttachmentProcessor:
@@ -18,13 +127,52 @@ class AttachmentProcessor:
         self.storage_path = Path(settings.ATTACHMENT_STORAGE_PATH)
         self.storage_path.mkdir(parents=True, exist_ok=True)
         self.missive = MissiveClient()
+        
+        # Shared pool so parallel downloads reuse keep-alive connections (plain urllib3:
+        # no requests Session/PreparedRequest overhead for a GET-to-file downloader);
+        # throttling and transient server errors are retried inside the pool. Retry-After is
+        # ignored: an unbounded server-chosen sleep would pin a worker and stall shutdown,
+        # so 429s get the same short backoff as 5xx
+        retries = Retry(
+            total=3, backoff_factor=0.3, status_forcelist=[429, 500, 502, 503, 504],
+            respect_retry_after_header=False, raise_on_status=False,
+        )
+        self.pool = urllib3.PoolManager(
+            num_pools=16, maxsize=settings.DOWNLOAD_CONCURRENCY, retries=retries, timeout=DOWNLOAD_TIMEOUT
+        )
+        
+        # Guards the folder caches below across download threads
+        self._lock = threading.Lock()
+        
+        # Folders already created by this process (skips a mkdir per attachment)
+        self._known_folders: Set[Path] = set()
+        
+        # Per-folder names on disk or handed out to in-flight downloads (one scandir per folder)
+        self._dir_cache: Dict[Path, Set[str]] = {}
+        
+        # Set on shutdown: in-flight downloads stop at their next chunk
+        self._cancelled = threading.Event()
+    
+    def cancel(self):
+        """Abort in-flight downloads and Missive retry waits (call before shutting down the pool)."""
+        self._cancelled.set()
+        self.missive.cancel()
     
-    def process(self, attachment: Dict[str, Any], db=None) -> str:
+    def close(self):
+        """Close HTTP connections."""
+        self.pool.clear()
+        self.missive.close()
+    
+    def process(self, attachment: Dict[str, Any], db=None, now_ts: Optional[int] = None) -> Tuple[str, int]:
         """
-        Download attachment and return the local path (relative to storage root).
+        Download attachment and return (local path relative to storage root, bytes written).
         
         Path structure: {project}/IBH-INBOX/{yyyymmdd}-{sender}-{subject}/{filename}(_{idx}).{ext}
+        now_ts lets a batch share one clock reading for the URL expiry check.
         """
+        if self._cancelled.is_set():
+            raise DownloadCancelled("Download cancelled: shutting down")
+        
         attachment_id = attachment['missive_attachment_id']
         message_id = attachment['missive_message_id']
         original_filename = attachment['original_filename']
@@ -38,60 +186,112 @@ class AttachmentProcessor:
         project_folder = self._sanitize_folder(project_name)
         email_folder = self._build_email_folder(delivered_at, sender_email, email_subject)
         folder_path = self.storage_path / project_folder / "IBH-INBOX" / email_folder
-        folder_path.mkdir(parents=True, exist_ok=True)
-        
-        # Generate filename with collision handling
-        local_filename = self._generate_unique_filename(folder_path, original_filename)
-        file_path = folder_path / local_filename
-        relative_path = f"{project_folder}/IBH-INBOX/{email_folder}/{local_filename}"
-        
-        # Skip if already exists (exact match)
-        if file_path.exists():
-            logger.info(f"Already exists: {relative_path}")
-            return relative_path
         
         # Check if URL is expired, refresh preemptively
-        if self._is_url_expired(url):
-            logger.info(f"URL expired for {attachment_id}, fetching fresh URL")
+        if self._is_url_expired(url, now_ts):
+            logger.info("URL expired for %s, fetching fresh URL", attachment_id)
             url = self._refresh_url(attachment_id, message_id, db)
         
-        # Download with retry on 403
-        logger.info(f"Downloading: {relative_path}")
-        content, _ = self._download_with_refresh(url, attachment_id, message_id, db)
+        # One temp file per row (rows are claimed by a single worker); a crash leaves only
+        # this .part behind, never a partial file under the final name
+        tmp_suffix = f".{_translate_allowed(attachment_id, _FILENAME_TABLE)}.part"
         
-        # Save
-        with open(file_path, 'wb') as f:
-            f.write(content)
+        for attempt in range(2):
+            self._ensure_folder(folder_path)
+            local_filename = None
+            try:
+                # Generate filename with collision handling (reserved in the folder cache until published)
+                with self._lock:
+                    local_filename = self._generate_unique_filename(folder_path, original_filename)
+                tmp_path = folder_path / f"{local_filename}{tmp_suffix}"
+                
+                # Download with retry on 403, streamed to the temp file, then published under its name
+                logger.debug("Downloading: %s/%s", folder_path, local_filename)
+                size, _ = self._download_with_refresh(url, tmp_path, attachment_id, message_id, db)
+                local_filename = self._publish(tmp_path, folder_path, local_filename, original_filename)
+                break
+            except FileNotFoundError:
+                # Folder removed after it was cached: forget it, then recreate and rescan it once
+                self._forget_folder(folder_path)
+                if attempt:
+                    raise
+            except Exception:
+                # Nothing was saved: release the name so the retry can reuse it
+                with self._lock:
+                    self._dir_cache.get(folder_path, set()).discard(local_filename)
+                raise
         
-        logger.info(f"Saved: {relative_path} ({len(content)} bytes)")
-        return relative_path
+        relative_path = f"{project_folder}/IBH-INBOX/{email_folder}/{local_filename}"
+        logger.debug("Saved: %s (%s bytes)", relative_path, size)
+        return relative_path, size
+    
+    def refresh_expiring_urls(self, attachments: List[Dict[str, Any]], db=None) -> int:
+        """
+        Refresh signed URLs that expire within URL_REFRESH_LEAD_SECONDS, updating the dicts in place.
+        
+        One Missive request per message covers all of its attachments. Returns count refreshed.
+        """
+        now_ts = int(time.time())
+        by_message: Dict[str, List[Dict[str, Any]]] = {}
+        for attachment in attachments:
+            if self._is_url_expired(attachment.get('original_url') or '', now_ts, URL_REFRESH_LEAD_SECONDS):
+                by_message.setdefault(attachment['missive_message_id'], []).append(attachment)
+        
+        refreshed = 0
+        for message_id, group in by_message.items():
+            fresh_urls = self.missive.get_fresh_attachment_urls(message_id)
+            for attachment in group:
+                attachment_id = attachment['missive_attachment_id']
+                fresh_url = fresh_urls.get(attachment_id)
+                if not fresh_url:
+                    continue  # process() retries the refresh as a safety net
+                attachment['original_url'] = fresh_url
+                if db:
+                    db.update_url(attachment_id, fresh_url)
+                refreshed += 1
+        
+        if refreshed:
+            logger.info("Refreshed %s expiring URLs ahead of download", refreshed)
+        return refreshed
+    
+    def _ensure_folder(self, folder_path: Path) -> None:
+        """Create folder once per process; later attachments for it skip the mkdir."""
+        if folder_path in self._known_folders:
+            return
+        folder_path.mkdir(parents=True, exist_ok=True)
+        with self._lock:
+            if len(self._known_folders) >= MAX_KNOWN_FOLDERS:
+                self._known_folders.clear()
+            self._known_folders.add(folder_path)
+    
+    def _forget_folder(self, folder_path: Path) -> None:
+        """Drop a folder from both caches so the next use recreates and rescans it."""
+        with self._lock:
+            self._known_folders.discard(folder_path)
+            self._dir_cache.pop(folder_path, None)
     
-    def _build_email_folder(self, delivered_at, sender_email: str, subject: str) -> str:
-        """Build email folder name: {yyyymmdd}-{sender}-{subject}"""
+    @staticmethod
+    @lru_cache(maxsize=2048)
+    def _build_email_folder(delivered_at, sender_email: str, subject: str) -> str:
+        """Build email folder name: {yyyymmdd}-{sender}-{subject}. Cached: attachments of one email share it."""
         # Parse date
-        if delivered_at:
-            try:
-                dt = datetime.fromisoformat(str(delivered_at).replace('Z', '+00:00'))
-                date_str = dt.strftime("%Y%m%d")
-            except (ValueError, TypeError):
-                date_str = "00000000"
-        else:
-            date_str = "00000000"
+        date_str = _format_delivered_date(delivered_at)
         
         # Sanitize sender (extract just the email, keep simple)
-        sender = re.sub(r'[^A-Za-z0-9@._-]', '_', sender_email)[:50]
+        sender = _translate_allowed(sender_email, _SENDER_TABLE)[:50]
         
         # Sanitize subject with max length
-        subject = self._sanitize_subject(subject)
+        subject = AttachmentProcessor._sanitize_subject(subject)
         
         return f"{date_str}-{sender}-{subject}"
     
-    def _sanitize_subject(self, subject: str) -> str:
+    @staticmethod
+    def _sanitize_subject(subject: str) -> str:
         """Sanitize email subject for use in folder name."""
         # Replace unsafe chars
-        subject = re.sub(r'[<>:"/\\|?*\x00-\x1f]', '_', subject)
+        subject = _replace_fs_unsafe(subject)
         # Replace multiple spaces/underscores
-        subject = re.sub(r'[\s_]+', '_', subject)
+        subject = _SUBJECT_RUNS_RE.sub('_', subject)
         # Trim
         subject = subject.strip(' ._')
         # Limit length
@@ -101,95 +301,150 @@ class AttachmentProcessor:
         return subject if subject else 'no-subject'
     
     def _generate_unique_filename(self, folder_path: Path, original_filename: str) -> str:
-        """Generate unique filename, adding _{idx} if collision exists."""
-        # Split name and extension
-        if '.' in original_filename:
-            name, ext = original_filename.rsplit('.', 1)
-            ext = ext.lower()
-        else:
-            name = original_filename
-            ext = ''
+        """Generate unique filename, adding _{idx} if collision exists. Caller holds self._lock."""
+        # Split name and extension (rpartition, not splitext: '.bashrc' keeps 'bashrc' as ext)
+        name, dot, ext = original_filename.rpartition('.')
+        if not dot:
+            name = ext
+        suffix = f".{ext.lower()}" if dot and ext else ''
         
         # Sanitize name
         name = self._sanitize_filename(name)
         
         # Build base filename
-        if ext:
-            base_filename = f"{name}.{ext}"
-        else:
-            base_filename = name
-        
-        # Check for collision
-        file_path = folder_path / base_filename
-        if not file_path.exists():
-            return base_filename
+        base_filename = f"{name}{suffix}"
         
-        # Add index suffix
+        # Collisions are resolved against the cached listing, and the chosen name is reserved
+        # in it; other writers to the same folder are caught when the file is published
+        names = self._folder_names(folder_path)
+        candidate = base_filename
         idx = 1
-        while True:
-            if ext:
-                indexed_filename = f"{name}_{idx}.{ext}"
-            else:
-                indexed_filename = f"{name}_{idx}"
-            
-            if not (folder_path / indexed_filename).exists():
-                return indexed_filename
+        while candidate in names:
+            candidate = f"{name}_{idx}{suffix}"
             idx += 1
+        names.add(candidate)
+        return candidate
+    
+    def _publish(self, tmp_path: Path, folder_path: Path, local_filename: str, original_filename: str) -> str:
+        """
+        Give a finished download its final name without ever overwriting an existing file.
+        
+        os.link fails atomically if the name was taken by another writer since it was reserved;
+        the next free name is tried then. Returns the name the file was saved under.
+        """
+        while True:
+            file_path = folder_path / local_filename
+            try:
+                os.link(tmp_path, file_path)
+                tmp_path.unlink(missing_ok=True)
+                return local_filename
+            except FileExistsError:
+                pass
+            except OSError as e:
+                if e.errno not in (errno.EPERM, errno.ENOTSUP, errno.EOPNOTSUPP, errno.ENOSYS):
+                    raise
+                # Filesystem without hard links: check the name is still free, then rename
+                if not file_path.exists():
+                    os.replace(tmp_path, file_path)
+                    return local_filename
+            with self._lock:
+                local_filename = self._generate_unique_filename(folder_path, original_filename)
+    
+    def _folder_names(self, folder_path: Path) -> Set[str]:
+        """Cached set of names in a folder, read once with os.scandir. Caller holds self._lock."""
+        names = self._dir_cache.get(folder_path)
+        if names is None:
+            if len(self._dir_cache) >= MAX_KNOWN_FOLDERS:
+                self._dir_cache.clear()
+            with os.scandir(folder_path) as entries:
+                names = {entry.name for entry in entries}
+            self._dir_cache[folder_path] = names
+        return names
     
     def _sanitize_filename(self, name: str) -> str:
         """Sanitize filename component."""
-        # Replace spaces and unsafe chars
-        name = name.replace(' ', '-')
-        name = re.sub(r'[^A-Za-z0-9._-]', '_', name)
+        # Replace spaces with '-' and unsafe chars with '_'
+        name = _translate_allowed(name, _FILENAME_TABLE)
         # Remove multiple underscores/dashes
-        name = re.sub(r'[-_]+', '-', name)
+        name = _FILENAME_RUNS_RE.sub('-', name)
         # Trim
         name = name.strip('-_')
         # Limit length
         return name[:100] if name else 'attachment'
     
-    def _sanitize_folder(self, name: str) -> str:
-        """Sanitize folder name (more permissive than filename)."""
-        name = re.sub(r'[<>:"/\\|?*\x00-\x1f]', '_', name)
+    @staticmethod
+    @lru_cache(maxsize=256)
+    def _sanitize_folder(name: str) -> str:
+        """Sanitize folder name (more permissive than filename). Cached: project names repeat."""
+        name = _replace_fs_unsafe(name)
         name = name.strip(' .')
         return name[:200] if name else 'Unknown'
     
-    def _is_url_expired(self, url: str, buffer_seconds: int = 60) -> bool:
+    def _is_url_expired(self, url: str, now_ts: Optional[int] = None, buffer_seconds: int = 60) -> bool:
         """Check if signed URL is expired or will expire soon."""
-        try:
-            parsed = urlparse(url)
-            params = parse_qs(parsed.query)
-            expires = params.get('Expires', [None])[0]
-            if expires:
-                expires_ts = int(expires)
-                now_ts = int(datetime.now(timezone.utc).timestamp())
-                return now_ts >= (expires_ts - buffer_seconds)
-        except (ValueError, TypeError):
-            pass
-        return False
+        expires_ts = url_expires_at(url)
+        if expires_ts is None:
+            return False
+        if now_ts is None:
+            now_ts = int(time.time())
+        return now_ts >= (expires_ts - buffer_seconds)
     
     def _refresh_url(self, attachment_id: str, message_id: str, db=None) -> str:
         """Fetch fresh URL from Missive API and update DB."""
         fresh_url = self.missive.get_fresh_attachment_url(message_id, attachment_id)
         if not fresh_url:
+            if self._cancelled.is_set():
+                # The Missive request gave up because of shutdown, not because the URL is gone
+                raise DownloadCancelled("Download cancelled: shutting down")
             raise Exception(f"Could not get fresh URL for attachment {attachment_id}")
         if db:
             db.update_url(attachment_id, fresh_url)
         return fresh_url
     
-    def _download_with_refresh(self, url: str, attachment_id: str, message_id: str, db=None) -> Tuple[bytes, bool]:
+    def _download_with_refresh(self, url: str, tmp_path: Path, attachment_id: str, message_id: str, db=None) -> Tuple[int, bool]:
         """Download with automatic URL refresh on 403."""
         try:
-            return self._download(url), False
-        except requests.HTTPError as e:
-            if e.response is not None and e.response.status_code == 403:
-                logger.info(f"Got 403 for {attachment_id}, refreshing URL")
+            return self._download(url, tmp_path), False
+        except DownloadHTTPError as e:
+            if e.status == 403:
+                logger.info("Got 403 for %s, refreshing URL", attachment_id)
+                self.missive.invalidate(message_id)  # The rejected URL may have come from the cache
                 fresh_url = self._refresh_url(attachment_id, message_id, db)
-                return self._download(fresh_url), True
+                return self._download(fresh_url, tmp_path), True
+            raise
+    
+    def _download(self, url: str, tmp_path: Path) -> int:
+        """Stream file from URL to tmp_path (removed again on failure). Returns bytes written."""
+        try:
+            response = self.pool.request('GET', url, preload_content=False)
+            try:
+                size = self._write_body(response, url, tmp_path)
+            except BaseException:
+                response.close()  # Body not fully read: drop the connection instead of pooling it
+                raise
+            response.release_conn()
+        except Exception:
+            tmp_path.unlink(missing_ok=True)
             raise
+        return size
     
-    def _download(self, url: str) -> bytes:
-        """Download file from URL."""
-        response = requests.get(url, timeout=60)
-        response.raise_for_status()
-        return response.content
+    def _write_body(self, response, url: str, tmp_path: Path) -> int:
+        """Stream a response body into tmp_path. Returns bytes written."""
+        if response.status >= 400:
+            raise DownloadHTTPError(response.status, url)
+        length = _content_length(response)
+        chunk_size = LARGE_DOWNLOAD_CHUNK_SIZE if length > LARGE_DOWNLOAD_BYTES else DOWNLOAD_CHUNK_SIZE
+        size = 0
+        # Buffer matches the chunk size, so large chunks go straight to write()
+        with open(tmp_path, 'wb', buffering=chunk_size) as f:
+            if length > LARGE_DOWNLOAD_BYTES:
+                _preallocate(f.fileno(), length)
+            for chunk in response.stream(chunk_size):
+                if self._cancelled.is_set():
+                    raise DownloadCancelled("Download cancelled: shutting down")
+                f.write(chunk)
+                size += len(chunk)
+        if length and size != length:
+            # Short body (connection cut): fail so the .part is discarded, never published
+            raise Exception(f"Incomplete download: got {size} of {length} bytes")
+        return size
@@ -1,6 +1,6 @@
 """Database operations via PostgREST API."""
 import httpx
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional, Set
 from datetime import datetime, timezone, timedelta
 
 from src import settings
@@ -12,12 +12,20 @@ class Database:
     
     def __init__(self):
         self.base_url = settings.POSTGREST_URL
+        self._files_url = f"{self.base_url}/email_attachment_files"
         self.headers = {
             "X-API-Key": settings.MAD_SERVICE_SECRET,
             "Content-Type": "application/json",
             "Prefer": "return=representation",
         }
-        self._client = httpx.Client(timeout=30.0)
+        # For writes whose response body is never read: PostgREST skips serializing the row
+        self._headers_minimal = {**self.headers, "Prefer": "return=minimal"}
+        # HTTP/2 lets the main and prefetch threads multiplex over one kept-alive connection
+        self._client = httpx.Client(
+            http2=True,
+            timeout=30.0,
+            limits=httpx.Limits(max_keepalive_connections=4, max_connections=8),
+        )
     
     def close(self):
         """Close HTTP client."""
@@ -32,32 +40,55 @@ class Database:
             response.raise_for_status()
             return response.json()
         except Exception as e:
-            logger.error(f"Failed to fetch pending attachments: {e}")
+            logger.error("Failed to fetch pending attachments: %s", e)
             return []
     
-    def mark_downloading(self, attachment_id: str) -> bool:
-        """Mark attachment as currently downloading (claim it)."""
+    def claim_batch(self, attachment_ids: List[str]) -> Set[str]:
+        """Claim pending attachments in one request. Returns the IDs this worker got."""
+        if not attachment_ids:
+            return set()
         try:
-            url = f"{self.base_url}/email_attachment_files"
+            url = self._files_url
             params = {
-                "missive_attachment_id": f"eq.{attachment_id}",
+                "missive_attachment_id": f"in.({','.join(attachment_ids)})",
                 "status": "eq.pending",
+                "select": "missive_attachment_id",
             }
             now = datetime.now(timezone.utc).isoformat()
             data = {"status": "downloading", "updated_at": now}
             
             response = self._client.patch(url, headers=self.headers, params=params, json=data)
             response.raise_for_status()
-            result = response.json()
-            return len(result) > 0
+            return {row["missive_attachment_id"] for row in response.json()}
         except Exception as e:
-            logger.error(f"Failed to mark downloading {attachment_id}: {e}")
-            return False
+            logger.error("Failed to claim batch of %s: %s", len(attachment_ids), e)
+            return set()
+    
+    def release_claims(self, attachment_ids: List[str]) -> int:
+        """Return claimed attachments this worker will not finish to 'pending'. Returns count released."""
+        if not attachment_ids:
+            return 0
+        try:
+            url = self._files_url
+            params = {
+                "missive_attachment_id": f"in.({','.join(attachment_ids)})",
+                "status": "eq.downloading",
+                "select": "missive_attachment_id",
+            }
+            now = datetime.now(timezone.utc).isoformat()
+            data = {"status": "pending", "updated_at": now}
+            
+            response = self._client.patch(url, headers=self.headers, params=params, json=data)
+            response.raise_for_status()
+            return len(response.json())
+        except Exception as e:
+            logger.error("Failed to release %s claims: %s", len(attachment_ids), e)
+            return 0
     
     def mark_completed(self, attachment_id: str, local_filename: str) -> None:
         """Mark attachment as successfully downloaded."""
         try:
-            url = f"{self.base_url}/email_attachment_files"
+            url = self._files_url
             params = {"missive_attachment_id": f"eq.{attachment_id}"}
             now = datetime.now(timezone.utc).isoformat()
             data = {
@@ -67,16 +98,16 @@ class Database:
                 "updated_at": now,
                 "error_message": None,
             }
-            response = self._client.patch(url, headers=self.headers, params=params, json=data)
+            response = self._client.patch(url, headers=self._headers_minimal, params=params, json=data)
             response.raise_for_status()
-            logger.info(f"Completed: {local_filename}")
+            logger.debug("Completed: %s", local_filename)
         except Exception as e:
-            logger.error(f"Failed to mark completed {attachment_id}: {e}")
+            logger.error("Failed to mark completed %s: %s", attachment_id, e)
     
     def mark_skipped(self, attachment_id: str, reason: str) -> None:
         """Mark attachment as skipped (not worth downloading)."""
         try:
-            url = f"{self.base_url}/email_attachment_files"
+            url = self._files_url
             params = {"missive_attachment_id": f"eq.{attachment_id}"}
             now = datetime.now(timezone.utc).isoformat()
             data = {
@@ -84,77 +115,98 @@ class Database:
                 "skip_reason": reason[:200],
                 "updated_at": now,
             }
-            response = self._client.patch(url, headers=self.headers, params=params, json=data)
+            response = self._client.patch(url, headers=self._headers_minimal, params=params, json=data)
             response.raise_for_status()
-            logger.info(f"Skipped: {attachment_id} - {reason}")
+            logger.debug("Skipped: %s - %s", attachment_id, reason)
         except Exception as e:
-            logger.error(f"Failed to mark skipped {attachment_id}: {e}")
+            logger.error("Failed to mark skipped %s: %s", attachment_id, e)
     
     def update_url(self, attachment_id: str, new_url: str) -> None:
         """Update the download URL with a fresh signed URL."""
         try:
-            url = f"{self.base_url}/email_attachment_files"
+            url = self._files_url
             params = {"missive_attachment_id": f"eq.{attachment_id}"}
             now = datetime.now(timezone.utc).isoformat()
             data = {"original_url": new_url, "updated_at": now}
-            response = self._client.patch(url, headers=self.headers, params=params, json=data)
+            response = self._client.patch(url, headers=self._headers_minimal, params=params, json=data)
             response.raise_for_status()
-            logger.debug(f"Updated URL for {attachment_id}")
+            logger.debug("Updated URL for %s", attachment_id)
         except Exception as e:
-            logger.error(f"Failed to update URL for {attachment_id}: {e}")
+            logger.error("Failed to update URL for %s: %s", attachment_id, e)
     
-    def mark_failed(self, attachment_id: str, error: str) -> None:
-        """Mark attachment as failed, increment retry count."""
+    def mark_failed(self, attachment_id: str, error: str, retry_count: Optional[int] = None) -> bool:
+        """
+        Mark attachment as failed, increment retry count. Returns whether the failure was recorded.
+        
+        Pass the row's retry_count when the caller already has it: the update is then a
+        single PATCH that only applies if the count is unchanged, falling back to a re-read.
+        A re-read that loses the race to a concurrent update is re-read and retried once.
+        """
         try:
-            # First get current retry_count
-            url = f"{self.base_url}/email_attachment_files"
-            params = {
-                "missive_attachment_id": f"eq.{attachment_id}",
-                "select": "retry_count",
-            }
-            response = self._client.get(url, headers=self.headers, params=params)
-            response.raise_for_status()
-            result = response.json()
-            
-            if not result:
-                logger.warning(f"Attachment not found: {attachment_id}")
-                return
-            
-            current_retry = result[0].get("retry_count", 0)
-            new_retry = current_retry + 1
-            
-            # Determine status based on retry count
-            status = "failed" if new_retry >= settings.MAX_RETRIES else "pending"
-            
-            now = datetime.now(timezone.utc).isoformat()
-            data = {
-                "status": status,
-                "retry_count": new_retry,
-                "error_message": error[:500],
-                "updated_at": now,
-            }
+            updated = retry_count is not None and self._increment_retry(attachment_id, error, retry_count)
+            for _ in range(2):
+                if updated:
+                    break
+                # Get current retry_count
+                url = self._files_url
+                params = {
+                    "missive_attachment_id": f"eq.{attachment_id}",
+                    "select": "retry_count",
+                }
+                response = self._client.get(url, headers=self.headers, params=params)
+                response.raise_for_status()
+                result = response.json()
+                
+                if not result:
+                    logger.warning("Attachment not found: %s", attachment_id)
+                    return False
+                
+                updated = self._increment_retry(attachment_id, error, result[0].get("retry_count", 0))
             
-            response = self._client.patch(
-                url, headers=self.headers,
-                params={"missive_attachment_id": f"eq.{attachment_id}"},
-                json=data
-            )
-            response.raise_for_status()
-            logger.warning(f"Failed: {attachment_id} - {error}")
+            if not updated:
+                logger.error("Failed to mark failed %s: retry_count changed concurrently", attachment_id)
+                return False
+            logger.warning("Failed: %s - %s", attachment_id, error)
+            return True
         except Exception as e:
-            logger.error(f"Failed to mark failed {attachment_id}: {e}")
+            logger.error("Failed to mark failed %s: %s", attachment_id, e)
+            return False
+    
+    def _increment_retry(self, attachment_id: str, error: str, current_retry: int) -> bool:
+        """Bump retry_count if it still equals current_retry. Returns whether the row was updated."""
+        new_retry = current_retry + 1
+        
+        # Determine status based on retry count
+        status = "failed" if new_retry >= settings.MAX_RETRIES else "pending"
+        
+        url = self._files_url
+        params = {
+            "missive_attachment_id": f"eq.{attachment_id}",
+            "retry_count": f"eq.{current_retry}",
+            "select": "missive_attachment_id",
+        }
+        now = datetime.now(timezone.utc).isoformat()
+        data = {
+            "status": status,
+            "retry_count": new_retry,
+            "error_message": error[:500],
+            "updated_at": now,
+        }
+        response = self._client.patch(url, headers=self.headers, params=params, json=data)
+        response.raise_for_status()
+        return bool(response.json())
     
     def reset_stuck_downloads(self, minutes: int = 30) -> int:
         """Reset downloads stuck in 'downloading' state."""
         try:
-            cutoff = (datetime.now(timezone.utc) - timedelta(minutes=minutes)).isoformat()
-            url = f"{self.base_url}/email_attachment_files"
+            now = datetime.now(timezone.utc)
+            cutoff = (now - timedelta(minutes=minutes)).isoformat()
+            url = self._files_url
             params = {
                 "status": "eq.downloading",
                 "updated_at": f"lt.{cutoff}",
             }
-            now = datetime.now(timezone.utc).isoformat()
-            data = {"status": "pending", "updated_at": now}
+            data = {"status": "pending", "updated_at": now.isoformat()}
             
             response = self._client.patch(url, headers=self.headers, params=params, json=data)
             response.raise_for_status()
@@ -162,8 +214,8 @@ class Database:
             count = len(result)
             
             if count > 0:
-                logger.warning(f"Reset {count} stuck downloads")
+                logger.warning("Reset %s stuck downloads", count)
             return count
         except Exception as e:
-            logger.error(f"Failed to reset stuck downloads: {e}")
+            logger.error("Failed to reset stuck downloads: %s", e)
             return 0
@@ -1,12 +1,24 @@
 """Logging configuration with Betterstack support."""
+import atexit
 import logging
+import queue
 import sys
-from logging.handlers import RotatingFileHandler
+from logging.handlers import MemoryHandler, QueueHandler, QueueListener, RotatingFileHandler
 from logtail import LogtailHandler
 
 from src import settings
 
 
+class _DeferredQueueHandler(QueueHandler):
+    """QueueHandler that enqueues records unformatted, so %-formatting runs on the listener thread.
+
+    Safe here because log arguments are immutable values (strings, numbers, exceptions).
+    """
+
+    def prepare(self, record):
+        return record
+
+
 def setup_logging():
     root_logger = logging.getLogger()
     root_logger.setLevel(getattr(logging, settings.LOG_LEVEL, logging.INFO))
@@ -17,16 +29,21 @@ def setup_logging():
     console_handler.setLevel(getattr(logging, settings.LOG_LEVEL, logging.INFO))
     console_formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
     console_handler.setFormatter(console_formatter)
-    root_logger.addHandler(console_handler)
+    handlers = [console_handler]
 
     # File handler
+    settings.LOGS_DIR.mkdir(exist_ok=True)
     log_file = settings.LOGS_DIR / "app.log"
     file_handler = RotatingFileHandler(log_file, maxBytes=10 * 1024 * 1024, backupCount=5)
     file_handler.setLevel(logging.INFO)
     file_handler.setFormatter(console_formatter)
-    root_logger.addHandler(file_handler)
+    # Batch routine records into one write per 512 lines; errors (and shutdown) flush at once
+    file_buffer = MemoryHandler(512, flushLevel=logging.ERROR, target=file_handler, flushOnClose=True)
+    file_buffer.setLevel(logging.INFO)  # flush() hands records to the target without a level check
+    handlers.append(file_buffer)
 
     # BetterStack handler
+    betterstack_status = None
     if settings.BETTERSTACK_SOURCE_TOKEN:
         try:
             handler_kwargs = {"source_token": settings.BETTERSTACK_SOURCE_TOKEN}
@@ -35,13 +52,24 @@ def setup_logging():
             betterstack_handler = LogtailHandler(**handler_kwargs)
             betterstack_handler.setLevel(logging.DEBUG)
             betterstack_handler.setFormatter(console_formatter)
-            root_logger.addHandler(betterstack_handler)
+            handlers.append(betterstack_handler)
             host_info = settings.BETTERSTACK_INGEST_HOST or "default (in.logs.betterstack.com)"
-            root_logger.info(f"BetterStack logging enabled (host: {host_info})")
+            betterstack_status = (logging.INFO, f"BetterStack logging enabled (host: {host_info})")
         except Exception as e:
-            root_logger.warning(f"Failed to initialize BetterStack logging: {e}")
+            betterstack_status = (logging.WARNING, f"Failed to initialize BetterStack logging: {e}")
+
+    # Callers only enqueue records; formatting and console, file and network I/O run on the listener thread
+    log_queue = queue.SimpleQueue()
+    listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)  # Drains queued records on exit
+    root_logger.addHandler(_DeferredQueueHandler(log_queue))
+
+    if betterstack_status:
+        root_logger.log(*betterstack_status)
 
     logging.getLogger("urllib3").setLevel(logging.WARNING)
+    logging.getLogger("httpx").setLevel(logging.WARNING)
     return root_logger
 
 
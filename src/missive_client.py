@@ -1,22 +1,103 @@
 """Minimal Missive API client for fetching fresh attachment URLs."""
+import random
+import threading
 import time
-from typing import Optional, Dict, Any
-import requests
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from functools import lru_cache
+from typing import Optional, Dict, Any, Tuple
+import httpx
 
 from src import settings
 from src.logging_conf import logger
 
+# Attachment URLs of recently fetched messages are reused for this long, but never
+# once one of them is within URL_REFRESH_LEAD_SECONDS of its signed expiry
+MESSAGE_CACHE_TTL = 300
+MESSAGE_CACHE_SIZE = 512
+
+# URLs expiring within this window are refreshed before their batch starts
+URL_REFRESH_LEAD_SECONDS = 300
+
+# Waits before each retry of a 5xx response or connection error (jittered +/-20%)
+RETRY_BACKOFF = (1, 2, 4)
+
+# 429 handling: waits per request before giving up, and bounds for the Retry-After wait
+MAX_RATE_LIMIT_WAITS = 5
+DEFAULT_RETRY_AFTER = 60
+MAX_RETRY_AFTER = 120
+
+
+def _retry_after_seconds(value: Optional[str]) -> float:
+    """Wait from a Retry-After header (delta-seconds or HTTP-date), clamped to [0, MAX_RETRY_AFTER]."""
+    if not value:
+        seconds = DEFAULT_RETRY_AFTER
+    else:
+        try:
+            seconds = float(value)
+        except ValueError:
+            try:
+                seconds = (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds()
+            except (TypeError, ValueError):
+                seconds = DEFAULT_RETRY_AFTER
+    return min(max(seconds, 0), MAX_RETRY_AFTER)
+
+
+@lru_cache(maxsize=1024)
+def url_expires_at(url: str) -> Optional[int]:
+    """Unix expiry from a signed URL's Expires param. Cached: retries see the same URL."""
+    # Substring scan instead of urlparse + parse_qs. Matching the leading ?/& skips
+    # X-Amz-Expires, which is a duration, not a timestamp
+    start = url.find('?Expires=')
+    if start < 0:
+        start = url.find('&Expires=')
+        if start < 0:
+            return None
+    start += len('?Expires=')
+    end = url.find('&', start)
+    value = url[start:end] if end >= 0 else url[start:]
+    try:
+        return int(value.partition('#')[0])
+    except ValueError:
+        return None
+
 
 class MissiveClient:
     """Fetches fresh attachment URLs from Missive API."""
     
     def __init__(self):
         self.base_url = "https://public.missiveapp.com/v1"
-        self.session = requests.Session()
-        self.session.headers.update({
-            "Authorization": f"Bearer {settings.MISSIVE_API_TOKEN}",
-            "Accept": "application/json"
-        })
+        # Shared by all download threads plus the prefetch thread; HTTP/2 multiplexes
+        # their message fetches over one kept-alive TLS connection
+        self._client = httpx.Client(
+            http2=True,
+            headers={
+                "Authorization": f"Bearer {settings.MISSIVE_API_TOKEN}",
+                "Accept": "application/json"
+            },
+            timeout=30.0,
+            limits=httpx.Limits(max_connections=settings.DOWNLOAD_CONCURRENCY + 1),
+        )
+        
+        # message_id -> (reusable_until unix time, {attachment_id: url}); shared across threads
+        self._url_cache: Dict[str, Tuple[float, Dict[str, str]]] = {}
+        self._cache_lock = threading.Lock()
+        
+        # Set on shutdown: retry waits end early and the request gives up
+        self._cancelled = threading.Event()
+    
+    def cancel(self):
+        """Stop waiting on rate limits/backoff; pending requests return None."""
+        self._cancelled.set()
+    
+    def close(self):
+        """Close HTTP client."""
+        self._client.close()
+    
+    def invalidate(self, message_id: str) -> None:
+        """Drop cached URLs for a message (e.g. after one of them was rejected)."""
+        with self._cache_lock:
+            self._url_cache.pop(message_id, None)
     
     def get_fresh_attachment_url(self, message_id: str, attachment_id: str) -> Optional[str]:
         """
@@ -29,55 +110,98 @@ class MissiveClient:
         Returns:
             Fresh signed URL or None if not found
         """
+        url = self.get_fresh_attachment_urls(message_id).get(attachment_id)
+        if url:
+            logger.info("Got fresh URL for attachment %s", attachment_id)
+            return url
+        
+        logger.warning("Attachment %s not found in message %s", attachment_id, message_id)
+        return None
+    
+    def get_fresh_attachment_urls(self, message_id: str) -> Dict[str, str]:
+        """
+        Fetch a message once and return fresh signed URLs for all its attachments.
+        Results are cached for MESSAGE_CACHE_TTL seconds, or until the earliest URL comes within
+        URL_REFRESH_LEAD_SECONDS of expiring; call invalidate() to force a refetch.
+        
+        Args:
+            message_id: Missive message ID
+            
+        Returns:
+            Mapping of attachment ID to fresh signed URL (empty if the fetch failed)
+        """
+        # Wall clock, since the signed expiries it is compared against are Unix timestamps
+        now = time.time()
+        with self._cache_lock:
+            cached = self._url_cache.get(message_id)
+        if cached and now < cached[0]:
+            return cached[1]
+        
         try:
             response = self._request("GET", f"/messages/{message_id}")
             if not response or "messages" not in response:
-                return None
+                return {}
             
             message = response["messages"]
             attachments = message.get("attachments", [])
             
-            for att in attachments:
-                if att.get("id") == attachment_id:
-                    url = att.get("url")
-                    if url:
-                        logger.info(f"Got fresh URL for attachment {attachment_id}")
-                        return url
+            urls = {att["id"]: att["url"] for att in attachments if att.get("id") and att.get("url")}
             
-            logger.warning(f"Attachment {attachment_id} not found in message {message_id}")
-            return None
+            # A cache hit must still be outside the refresh lead window, or the caller
+            # would get a URL that is refreshed (or rejected) again right away
+            reusable_until = now + MESSAGE_CACHE_TTL
+            for url in urls.values():
+                expires_ts = url_expires_at(url)
+                if expires_ts is not None:
+                    reusable_until = min(reusable_until, expires_ts - URL_REFRESH_LEAD_SECONDS)
+            
+            with self._cache_lock:
+                if len(self._url_cache) >= MESSAGE_CACHE_SIZE:
+                    # Evict the oldest entry (dicts keep insertion order)
+                    self._url_cache.pop(next(iter(self._url_cache)))
+                self._url_cache[message_id] = (reusable_until, urls)
+            return urls
             
         except Exception as e:
-            logger.error(f"Failed to fetch fresh URL for {attachment_id}: {e}")
-            return None
+            logger.error("Failed to fetch fresh URLs for message %s: %s", message_id, e)
+            return {}
     
-    def _request(self, method: str, endpoint: str, retry_count: int = 0) -> Optional[Dict[str, Any]]:
+    def _request(self, method: str, endpoint: str) -> Optional[Dict[str, Any]]:
         """Make API request with retry logic."""
         url = f"{self.base_url}{endpoint}"
+        retry_count = 0
+        rate_limit_waits = 0
         
-        try:
-            response = self.session.request(method=method, url=url, timeout=30)
-            
-            if response.status_code == 429:
-                retry_after = int(response.headers.get("Retry-After", 60))
-                logger.warning(f"Rate limited. Waiting {retry_after}s...")
-                time.sleep(retry_after)
-                return self._request(method, endpoint, retry_count)
-            
-            if response.status_code >= 500 and retry_count < 3:
-                wait_time = 2 ** retry_count
-                logger.warning(f"Server error {response.status_code}. Retrying in {wait_time}s...")
-                time.sleep(wait_time)
-                return self._request(method, endpoint, retry_count + 1)
-            
-            response.raise_for_status()
-            return response.json()
-            
-        except requests.exceptions.RequestException as e:
-            if retry_count < 3 and isinstance(e, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
-                wait_time = 2 ** retry_count
-                time.sleep(wait_time)
-                return self._request(method, endpoint, retry_count + 1)
-            logger.error(f"Missive API request failed: {e}")
-            return None
+        while True:
+            try:
+                response = self._client.request(method, url)
+                
+                if response.status_code == 429 and rate_limit_waits < MAX_RATE_LIMIT_WAITS:
+                    # Rate limit waits have their own budget; once spent, the 429 fails the request
+                    retry_after = _retry_after_seconds(response.headers.get("Retry-After"))
+                    logger.warning("Rate limited. Waiting %.0fs...", retry_after)
+                    if self._cancelled.wait(retry_after):
+                        return None
+                    rate_limit_waits += 1
+                    continue
+                
+                if response.status_code >= 500 and retry_count < len(RETRY_BACKOFF):
+                    wait_time = RETRY_BACKOFF[retry_count] * random.uniform(0.8, 1.2)
+                    logger.warning("Server error %s. Retrying in %.1fs...", response.status_code, wait_time)
+                    if self._cancelled.wait(wait_time):
+                        return None
+                    retry_count += 1
+                    continue
+                
+                response.raise_for_status()
+                return response.json()
+                
+            except httpx.HTTPError as e:
+                if retry_count < len(RETRY_BACKOFF) and isinstance(e, (httpx.NetworkError, httpx.TimeoutException)):
+                    if self._cancelled.wait(RETRY_BACKOFF[retry_count] * random.uniform(0.8, 1.2)):
+                        return None
+                    retry_count += 1
+                    continue
+                logger.error("Missive API request failed: %s", e)
+                return None
 
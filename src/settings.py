@@ -8,7 +8,6 @@ load_dotenv()
 # Base paths
 BASE_DIR = Path(__file__).resolve().parent.parent
 LOGS_DIR = BASE_DIR / "logs"
-LOGS_DIR.mkdir(exist_ok=True)
 
 # Logging
 LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
@@ -29,8 +28,11 @@ ATTACHMENT_STORAGE_PATH = os.getenv("ATTACHMENT_STORAGE_PATH")
 
 # Worker settings
 POLL_INTERVAL = int(os.getenv("POLL_INTERVAL", "5"))
+MAX_POLL_INTERVAL = int(os.getenv("MAX_POLL_INTERVAL", "60"))  # Idle polls back off up to this
 BATCH_SIZE = int(os.getenv("BATCH_SIZE", "10"))
 MAX_RETRIES = int(os.getenv("MAX_RETRIES", "3"))
+DOWNLOAD_CONCURRENCY = int(os.getenv("DOWNLOAD_CONCURRENCY", "8"))  # Parallel downloads per batch
+MAX_PER_HOST_CONCURRENCY = int(os.getenv("MAX_PER_HOST_CONCURRENCY", "8"))  # Parallel downloads per URL host
 
 # Skip filter: images below these thresholds are skipped
 SKIP_IMAGE_MIN_SIZE = int(os.getenv("SKIP_IMAGE_MIN_SIZE", "25000"))  # 25KB
@@ -68,5 +70,11 @@ def validate_config():
             except Exception as e:
                 errors.append(f"Cannot create ATTACHMENT_STORAGE_PATH: {e}")
     
+    # Zero workers would claim batches forever without downloading any of them
+    if DOWNLOAD_CONCURRENCY < 1:
+        errors.append(f"DOWNLOAD_CONCURRENCY must be at least 1: {DOWNLOAD_CONCURRENCY}")
+    if MAX_PER_HOST_CONCURRENCY < 1:
+        errors.append(f"MAX_PER_HOST_CONCURRENCY must be at least 1: {MAX_PER_HOST_CONCURRENCY}")
+    
     if errors:
         raise ValueError("Config errors:\n  " + "\n  ".join(errors))